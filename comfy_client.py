@@ -1,109 +1,492 @@
 import uuid
-import json
-import urllib.request
-import urllib.parse
-import urllib.error
 import time
+import random
 import os
 import io
+import shutil
+import socket
 import logging
-from typing import Dict, List
-from PIL import Image
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Union
+import requests
+import websocket
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 
 from utils import (
     ensure_folder,
     upload_to_s3,
-    str2bool,
+    get_s3_client,
     get_s3_config,
-    get_image_file
+    json_loads,
+    json_dumps,
+    workflow_key,
+    load_poll_stats,
+    record_completion_time,
+    lognormal_poll_schedule
 )
 
 
+MAX_WORKERS = 8
+
+# Polling fallback schedule (seconds), used when the WebSocket is unavailable
+POLL_INITIAL_INTERVAL = 0.1
+POLL_MAX_INTERVAL = 10
+POLL_MAX_ERROR_INTERVAL = 60
+# Completion samples needed before polls are placed from the fitted distribution
+POLL_MIN_SAMPLES = 5
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that enables TCP keepalive so idle pooled connections stay open.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+class PromptExecutionError(RuntimeError):
+    """
+    Raised when a prompt has left the queue without producing outputs (e.g. a node failed).
+    """
+
+
+def prompt_outputs(prompt_id: str, history: dict) -> dict:
+    """
+    Outputs of a prompt that has left the queue; raises PromptExecutionError if it has none.
+    """
+    entry = history.get(prompt_id) or {}
+    if entry.get("outputs"):
+        return entry["outputs"]
+    status = entry.get("status", {})
+    raise PromptExecutionError(
+        f"Prompt {prompt_id} finished without outputs "
+        f"(status: {status.get('status_str', 'unknown')}): {status.get('messages', [])}"
+    )
+
+
+def status_timestamp(history_entry: dict, name: str) -> Optional[float]:
+    """
+    Server-side epoch seconds of the named status message (e.g. 'execution_start') in a history entry.
+    """
+    for message_name, data in history_entry.get("status", {}).get("messages", []):
+        if message_name == name and "timestamp" in data:
+            return data["timestamp"] / 1000
+    return None
+
+
 class ComfyUIClient:
     def __init__(self, server_address: str):
         self.server_address = server_address.rstrip("/")
         self.client_id = str(uuid.uuid4())
+        # prompt_id -> (workflow key, queue time), for completion-time statistics
+        self._queued: Dict[str, tuple] = {}
+        # Prompts whose completion event was read off the WebSocket while waiting on others
+        self._finished: set = set()
+        self.http = requests.Session()
+        adapter = KeepAliveAdapter(pool_connections=16, pool_maxsize=16)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        # Open a pooled connection in the background so the first real request skips the handshake
+        threading.Thread(target=self._warm_up, daemon=True).start()
+        self.ws = None
+        self.connect()
+
+        self.s3_config = get_s3_config()
+        self.s3_client = get_s3_client(
+            region=self.s3_config["region"],
+            access_key=self.s3_config["access_key"],
+            secret_key=self.s3_config["secret_key"],
+            endpoint_url=self.s3_config["endpoint"]
+        ) if self.s3_config["enabled"] else None
+
+    def connect(self) -> bool:
+        """
+        Opens the WebSocket used to wait for completion.
+        Returns False (and leaves self.ws unset) if it cannot be opened, in which case
+        wait_for_execution falls back to polling /queue.
+        """
+        self._close_ws()
+        ws = websocket.WebSocket()
+        try:
+            ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
+        except (websocket.WebSocketException, OSError) as e:
+            logging.warning(f"WebSocket unavailable ({e}), falling back to polling.")
+            return False
+        self.ws = ws
+        return True
+
+    def _warm_up(self):
+        try:
+            self.http.head(f"http://{self.server_address}/", timeout=5)
+        except requests.RequestException as e:
+            logging.debug(f"Connection warm-up failed: {e}")
+
+    def close(self):
+        self._close_ws()
+        self.http.close()
+
+    def _close_ws(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception as e:
+                logging.warning(f"Error closing WebSocket: {e}")
+            self.ws = None
 
     def queue_prompt(self, prompt: dict) -> str:
         url = f"http://{self.server_address}/prompt"
         headers = {"Content-Type": "application/json"}
-        data = json.dumps({"prompt": prompt}).encode("utf-8")
+        data = json_dumps({"prompt": prompt, "client_id": self.client_id})
 
-        req = urllib.request.Request(url, data=data, headers=headers, method="POST")
+        response = self.http.post(url, data=data, headers=headers)
         try:
-            with urllib.request.urlopen(req) as response:
-                return json.loads(response.read())["prompt_id"]
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode()
-            logging.error(f"HTTP {e.code}: {e.reason} | {error_body}")
+            response.raise_for_status()
+        except requests.HTTPError:
+            logging.error(f"HTTP {response.status_code}: {response.reason} | {response.text}")
             raise
+        prompt_id = json_loads(response.content)["prompt_id"]
+        self._queued[prompt_id] = (workflow_key(prompt), time.time())
+        return prompt_id
 
     def get_history(self, prompt_id: str) -> dict:
         url = f"http://{self.server_address}/history/{prompt_id}"
-        with urllib.request.urlopen(url) as response:
-            return json.loads(response.read())
+        response = self.http.get(url)
+        response.raise_for_status()
+        return json_loads(response.content)
+
+    def get_histories(self, prompt_ids) -> dict:
+        """
+        Fetches /history/{id} for each prompt concurrently and merges the results,
+        instead of downloading the server's entire history.
+        """
+        prompt_ids = list(prompt_ids)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            results = list(executor.map(self.get_history, prompt_ids))
+        history = {}
+        for result in results:
+            history.update(result)
+        return history
+
+    def get_queue(self) -> dict:
+        response = self.http.get(f"http://{self.server_address}/queue")
+        response.raise_for_status()
+        return json_loads(response.content)
+
+    def queued_prompt_ids(self) -> set:
+        """
+        Ids of prompts that are running or pending on the server.
+        """
+        queue = self.get_queue()
+        return {item[1] for item in queue.get("queue_running", []) + queue.get("queue_pending", [])}
 
-    def wait_for_execution(self, prompt_id: str, timeout: int = 300, interval: int = 5) -> dict:
-        start_time = time.time()
+    def is_done(self, prompt_id: str) -> bool:
+        return prompt_id not in self.queued_prompt_ids()
+
+    def get_image_file(self, filename: str, subfolder: str, folder_type: str) -> bytes:
+        with self.stream_image_file(filename, subfolder, folder_type) as response:
+            return response.content
+
+    def stream_image_file(self, filename: str, subfolder: str, folder_type: str) -> requests.Response:
+        """
+        Returns the streamed /view response; use it as a context manager and read from .raw.
+        """
+        params = {
+            "filename": filename,
+            "subfolder": subfolder,
+            "type": folder_type
+        }
+        response = self.http.get(f"http://{self.server_address}/view", params=params, stream=True)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        response.raw.decode_content = True
+        return response
+
+    def wait_for_execution(self, prompt_id: str, timeout: int = 300,
+                           poll_base: float = 1.3, poll_jitter: float = 0.2) -> dict:
+        """
+        Blocks on the WebSocket until ComfyUI reports the prompt finished
+        (an 'executing' message with node=None), then fetches its history once.
+        Without a WebSocket, polls the compact /queue listing instead (at times placed from
+        past completion times of the same workflow when enough are known, then with
+        exponential backoff) and reads /history once the prompt has left the queue.
+        """
+        deadline = time.time() + timeout
         logging.info(f"Waiting for prompt {prompt_id} to complete...")
 
-        while time.time() - start_time < timeout:
+        if not self._wait_ws({prompt_id}, deadline):
+            return self._poll_for_execution(prompt_id, deadline, poll_base, poll_jitter)
+
+        history = self.get_history(prompt_id)
+        outputs = prompt_outputs(prompt_id, history)
+        logging.info("Prompt execution completed.")
+        self._record_completion(prompt_id, history[prompt_id])
+        return outputs
+
+    def wait_for_many(self, prompt_ids: List[str], timeout: int = 300,
+                      poll_base: float = 1.3, poll_jitter: float = 0.2) -> Dict[str, dict]:
+        """
+        Waits for several prompts at once and returns their outputs keyed by prompt id.
+        Completion is checked with a single /queue request per poll, whatever the number of prompts;
+        each prompt's history is fetched once they have all left the queue.
+        """
+        deadline = time.time() + timeout
+        prompt_ids = set(prompt_ids)
+        logging.info(f"Waiting for {len(prompt_ids)} prompts to complete...")
+
+        # If the WebSocket saw every prompt finish, there is no need to ask /queue
+        ws_done = self._wait_ws(set(prompt_ids), deadline)
+
+        def check() -> Optional[Dict[str, dict]]:
+            if not ws_done and self.queued_prompt_ids().intersection(prompt_ids):
+                return None
+            # None of the prompts is queued any more, so a missing output is a failure, not a wait
+            history = self.get_histories(prompt_ids)
+            outputs = {prompt_id: prompt_outputs(prompt_id, history) for prompt_id in prompt_ids}
+            for prompt_id in outputs:
+                self._record_completion(prompt_id, history[prompt_id])
+            return outputs
+
+        outputs = self._poll_until(check, deadline, poll_base, poll_jitter)
+        logging.info("All prompts completed.")
+        return outputs
+
+    def _wait_ws(self, pending: set, deadline: float) -> bool:
+        """
+        Consumes WebSocket events, removing prompts from pending as they finish.
+        Completions of other prompts are remembered so a later wait on them returns at once.
+        Returns True once pending is empty, or False if the WebSocket is unavailable.
+        """
+        reconnect_delay = 0.0
+
+        while True:
+            seen = pending & self._finished
+            pending -= seen
+            self._finished -= seen
+            if not pending or self.ws is None:
+                break
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError("Prompt execution timed out.")
             try:
-                history = self.get_history(prompt_id)
-                if prompt_id in history and history[prompt_id].get("outputs"):
+                self.ws.settimeout(remaining)
+                out = self.ws.recv()
+            except websocket.WebSocketTimeoutException:
+                raise TimeoutError("Prompt execution timed out.")
+            except (websocket.WebSocketException, OSError) as e:
+                logging.warning(f"WebSocket error: {e}, reconnecting...")
+                # Back off if the socket keeps failing right after reconnecting
+                time.sleep(max(0, min(reconnect_delay, deadline - time.time())))
+                reconnect_delay = min(max(reconnect_delay * 2, POLL_INITIAL_INTERVAL), POLL_MAX_ERROR_INTERVAL)
+                if not self.connect():
+                    break  # Fall back to polling
+                # Messages may have been missed while disconnected
+                try:
+                    history = self.get_histories(pending)
+                except requests.RequestException as e:
+                    logging.warning(f"History check after reconnect failed: {e}")
+                    continue
+                # A history entry means the prompt finished, successfully or not
+                for prompt_id in [p for p in pending if p in history]:
+                    pending.discard(prompt_id)
+                    self._record_completion(prompt_id, history[prompt_id])
+                continue
+
+            reconnect_delay = 0.0
+
+            if not isinstance(out, str):
+                continue  # Binary preview frames
+            message = json_loads(out)
+            if message.get("type") != "executing":
+                continue
+            data = message.get("data", {})
+            if data.get("node") is None and data.get("prompt_id"):
+                self._finished.add(data["prompt_id"])
+
+        return not pending
+
+    def _poll_schedule(self, prompt_id: str) -> List[float]:
+        """
+        Absolute poll times fitted to this workflow's past run times, if enough are known.
+        The schedule starts at queue time; samples exclude queue wait, so on a busy server the
+        fitted polls come early and the backoff that follows covers the remainder.
+        """
+        if prompt_id not in self._queued:
+            return []
+        key, queued_at = self._queued[prompt_id]
+        samples = load_poll_stats().get(key, [])
+        if len(samples) < POLL_MIN_SAMPLES:
+            return []
+        return [queued_at + offset for offset in lognormal_poll_schedule(samples)]
+
+    def _record_completion(self, prompt_id: str, history_entry: dict):
+        """
+        Records how long the prompt ran, from execution_start to execution_success.
+        Both timestamps come from the server's clock, so client/server skew and the delay
+        before the client noticed completion do not bias the sample; time spent waiting in
+        the queue is not included.
+        """
+        queued = self._queued.pop(prompt_id, None)
+        if queued is None:
+            return
+        key, _ = queued
+        started = status_timestamp(history_entry, "execution_start")
+        finished = status_timestamp(history_entry, "execution_success")
+        if started is not None and finished is not None and finished >= started:
+            record_completion_time(key, finished - started)
+
+    def _poll_for_execution(self, prompt_id: str, deadline: float,
+                            poll_base: float, poll_jitter: float) -> dict:
+        def check() -> Optional[dict]:
+            if not self.is_done(prompt_id):
+                return None
+            # Off the queue, so a missing output is a failure rather than something to wait for
+            history = self.get_history(prompt_id)
+            outputs = prompt_outputs(prompt_id, history)
+            self._record_completion(prompt_id, history[prompt_id])
+            return outputs
+
+        schedule = self._poll_schedule(prompt_id)
+        for poll_at in schedule:
+            time.sleep(max(0, min(poll_at, deadline) - time.time()))
+            if time.time() >= deadline:
+                break
+            try:
+                outputs = check()
+                if outputs is not None:
                     logging.info("Prompt execution completed.")
-                    return history[prompt_id]["outputs"]
+                    return outputs
+            except PromptExecutionError:
+                raise
+            except Exception as e:
+                logging.warning(f"Polling error: {e}")
+
+        # Past the fitted schedule, keep backing off from its last gap rather than restarting
+        if len(schedule) >= 2:
+            outputs = self._poll_until(check, deadline, poll_base, poll_jitter,
+                                       interval=schedule[-1] - schedule[-2], check_first=False)
+        else:
+            outputs = self._poll_until(check, deadline, poll_base, poll_jitter)
+        logging.info("Prompt execution completed.")
+        return outputs
+
+    def _poll_until(self, check: Callable, deadline: float, poll_base: float, poll_jitter: float,
+                    interval: float = POLL_INITIAL_INTERVAL, check_first: bool = True):
+        """
+        Calls check() with exponential backoff plus jitter, starting at interval,
+        until it returns a result. Errors use a separate, steeper backoff.
+        With check_first=False the first check waits one interval (the caller just polled).
+        """
+        error_interval = POLL_INITIAL_INTERVAL
+
+        if not check_first:
+            delay = min(interval, POLL_MAX_INTERVAL) + random.uniform(0, poll_jitter)
+            interval *= poll_base
+            time.sleep(max(0, min(delay, deadline - time.time())))
+
+        while time.time() < deadline:
+            try:
+                result = check()
+                if result is not None:
+                    return result
+                delay = min(interval, POLL_MAX_INTERVAL)
+                interval *= poll_base
+                error_interval = POLL_INITIAL_INTERVAL
+            except PromptExecutionError:
+                raise
             except Exception as e:
                 logging.warning(f"Polling error: {e}")
-            time.sleep(interval)
+                delay = min(error_interval, POLL_MAX_ERROR_INTERVAL)
+                error_interval *= 2
+            delay += random.uniform(0, poll_jitter)
+            time.sleep(max(0, min(delay, deadline - time.time())))
 
         raise TimeoutError("Prompt execution timed out.")
 
+    def fetch_images(self, outputs: dict) -> Dict[str, List[bytes]]:
+        """
+        Downloads all output images concurrently, preserving per-node order.
+        """
+        metas = [
+            (node_id, image)
+            for node_id, output in outputs.items()
+            for image in output.get("images", [])
+        ]
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            results = list(executor.map(
+                lambda m: self.get_image_file(m[1]["filename"], m[1]["subfolder"], m[1]["type"]),
+                metas
+            ))
+
+        images: Dict[str, List[bytes]] = {node_id: [] for node_id in outputs}
+        for (node_id, _), image_data in zip(metas, results):
+            images[node_id].append(image_data)
+
+        return images
+
     def get_images(self, prompt: dict) -> (Dict[str, List[bytes]], str):
         prompt_id = self.queue_prompt(prompt)
         outputs = self.wait_for_execution(prompt_id)
-        images: Dict[str, List[bytes]] = {}
+        return self.fetch_images(outputs), prompt_id
 
-        for node_id, output in outputs.items():
-            node_images = []
-            for image in output.get("images", []):
-                image_data = get_image_file(self.server_address, image["filename"], image["subfolder"], image["type"])
-                node_images.append(image_data)
-            images[node_id] = node_images
+    def display_images(self, images: Dict[str, List[Union[bytes, str]]]):
+        """
+        Shows images given either as raw bytes or as paths to saved files.
+        """
+        from PIL import Image
 
-        return images, prompt_id
-
-    def display_images(self, images: Dict[str, List[bytes]]):
         for node_id, image_list in images.items():
             for idx, data in enumerate(image_list, 1):
-                image = Image.open(io.BytesIO(data))
+                image = Image.open(io.BytesIO(data) if isinstance(data, bytes) else data)
                 logging.info(f"Displaying image {idx} from node {node_id}")
                 image.show()
 
-    def save_images(self, images: Dict[str, List[bytes]], prompt_id: str):
+    def save_images(self, outputs: dict, prompt_id: str) -> Dict[str, List[str]]:
+        """
+        Streams each output image from /view straight to disk (and S3, if enabled)
+        without holding the whole image in memory. Returns the local paths per node.
+        """
         output_dir = os.path.join("saved_images", prompt_id)
         ensure_folder(output_dir)
 
-        s3_enabled = str2bool(os.getenv("UPLOAD_TO_S3", "no"))
-        s3_config = get_s3_config() if s3_enabled else None
+        def save_one(node_id: str, idx: int, image: dict):
+            filename = f"{node_id}_{idx}.png"
+            local_path = os.path.join(output_dir, filename)
 
-        for node_id, image_list in images.items():
-            for idx, data in enumerate(image_list, 1):
-                filename = f"{node_id}_{idx}.png"
-                local_path = os.path.join(output_dir, filename)
-
-                image = Image.open(io.BytesIO(data))
-                image.save(local_path)
-                logging.info(f"Saved image: {local_path}")
+            # ComfyUI already serves PNG bytes, so write them as-is
+            with self.stream_image_file(image["filename"], image["subfolder"], image["type"]) as response, \
+                    open(local_path, "wb") as f:
+                shutil.copyfileobj(response.raw, f)
+            logging.info(f"Saved image: {local_path}")
 
-                if s3_enabled and s3_config:
-                    s3_key = f"comfyui/{prompt_id}/{filename}"
+            if self.s3_client:
+                s3_key = f"comfyui/{prompt_id}/{filename}"
+                with open(local_path, "rb") as f:
                     upload_to_s3(
-                        image_bytes=data,
-                        bucket_name=s3_config["bucket"],
+                        s3_client=self.s3_client,
+                        bucket_name=self.s3_config["bucket"],
                         object_key=s3_key,
-                        region=s3_config["region"],
-                        access_key=s3_config["access_key"],
-                        secret_key=s3_config["secret_key"],
-                        endpoint_url=s3_config["endpoint"]
+                        fileobj=f,
+                        compress=self.s3_config["compress"]
                     )
+            return local_path
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                node_id: [
+                    executor.submit(save_one, node_id, idx, image)
+                    for idx, image in enumerate(output.get("images", []), 1)
+                ]
+                for node_id, output in outputs.items()
+            }
+            return {node_id: [future.result() for future in node_futures] for node_id, node_futures in futures.items()}
@@ -4,7 +4,7 @@ import os
 from dotenv import load_dotenv
 from comfy_client import ComfyUIClient
 from utils import (
-    load_workflow, str2bool, patch_load_image_node,
+    load_workflow, index_workflow, str2bool, patch_load_image_node,
     patch_prompt_text_node, upload_input_image
 )
 
@@ -18,6 +18,7 @@ def get_env_defaults():
         "server": os.getenv("SERVER_ADDRESS", "127.0.0.1:8188"),
         "workflow": os.getenv("DEFAULT_WORKFLOW", "workflow1.json"),
         "save_images": str2bool(os.getenv("SAVE_IMAGES", "yes")),
+        "display_images": str2bool(os.getenv("COMFY_DISPLAY", "no")),
     }
 
 
@@ -28,27 +29,35 @@ def parse_arguments(defaults):
     parser.add_argument("--server", type=str, default=defaults["server"], help="ComfyUI server address (host:port)")
     parser.add_argument("--save", action="store_true", default=defaults["save_images"], help="Save images to disk")
     parser.add_argument("--nosave", action="store_false", dest="save", help="Do not save images")
+    parser.add_argument("--display", action="store_true", default=defaults["display_images"],
+                        help="Decode and show output images")
     parser.add_argument("--upload_image", type=str, help="Path or URL of image to upload and inject into workflow")
     return parser.parse_args()
 
 
 def run_prompt_pipeline(args):
     workflow = load_workflow(args.workflow)
+    index = index_workflow(workflow)
     client = ComfyUIClient(args.server)
 
-    if args.upload_image:
-        upload_info = upload_input_image(args.upload_image, client.server_address)
-        patch_load_image_node(workflow, upload_info)
+    try:
+        if args.upload_image:
+            upload_info = upload_input_image(args.upload_image, client.server_address, client.http)
+            patch_load_image_node(workflow, upload_info, index)
 
-    if args.prompt:
-        patch_prompt_text_node(workflow, args.prompt)
+        if args.prompt:
+            patch_prompt_text_node(workflow, args.prompt, index)
 
-    images, prompt_id = client.get_images(workflow)
+        prompt_id = client.queue_prompt(workflow)
+        outputs = client.wait_for_execution(prompt_id)
 
-    if args.save:
-        client.save_images(images, prompt_id)
+        saved_paths = client.save_images(outputs, prompt_id) if args.save else None
 
-    client.display_images(images)
+        if args.display:
+            # Reuse the saved files rather than downloading every image a second time
+            client.display_images(saved_paths or client.fetch_images(outputs))
+    finally:
+        client.close()
 
 
 def main():
@@ -1,22 +1,53 @@
 import os
+import gzip
 import json
-import logging
+import math
+import uuid
+import shutil
+import hashlib
 import tempfile
+import logging
+import mimetypes
 import boto3
-import urllib.request
+import requests
+from collections import defaultdict
+from functools import lru_cache
+from statistics import NormalDist, fmean, pstdev
 from urllib.parse import urlparse
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, NoCredentialsError
-from typing import Tuple
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
 
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
 
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+
+@lru_cache(maxsize=1)
 def get_s3_config():
+    """
+    Reads the S3 settings from the environment once per process.
+    """
     return {
         "bucket": os.getenv("S3_BUCKET_NAME"),
         "access_key": os.getenv("S3_ACCESS_KEY"),
         "secret_key": os.getenv("S3_SECRET_KEY"),
         "region": os.getenv("AWS_REGION", "us-west-2"),
         "endpoint": os.getenv("S3_ENDPOINT_URL"),
-        "enabled": os.getenv("UPLOAD_TO_S3", "no").lower() in ("1", "true", "yes", "y"),
+        "enabled": str2bool(os.getenv("UPLOAD_TO_S3", "no")),
+        "compress": str2bool(os.getenv("COMPRESS_S3", "no")),
     }
 
 
@@ -27,112 +58,268 @@ def str2bool(value: str) -> bool:
 def load_workflow(path: str) -> dict:
     if not os.path.exists(path):
         raise FileNotFoundError(f"Workflow file not found: {path}")
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(path, "rb") as f:
+        return json_loads(f.read())
 
 
-def patch_prompt_text_node(workflow: dict, prompt_text: str) -> None:
+def index_workflow(workflow: dict) -> Dict[str, List[str]]:
+    """
+    Maps each class_type to the ids of its nodes, in workflow order.
+    """
+    index = defaultdict(list)
+    for node_id, node in workflow.items():
+        if isinstance(node, dict):
+            index[node.get("class_type")].append(node_id)
+    return index
+
+
+def patch_prompt_text_node(workflow: dict, prompt_text: str, index: Dict[str, List[str]] = None) -> None:
     """
     Replaces 'text' input of the first CLIPTextEncode node that is the positive prompt and not a negative prompt.
     Skips nodes with 'negative' in their _meta title.
     """
-    for node_id, node in workflow.items():
-        if isinstance(node, dict) and node.get("class_type") == "CLIPTextEncode":
-            title = node.get("_meta", {}).get("title", "").lower()
-            if "negative" in title:
-                continue  # Skip negative prompt node
-            inputs = node.get("inputs", {})
-            if "text" in inputs:
-                logging.info(f"Patching CLIPTextEncode node {node_id} (title: {title}) with new prompt.")
-                inputs["text"] = prompt_text
-                return
+    if index is None:
+        index = index_workflow(workflow)
+    for node_id in index.get("CLIPTextEncode", []):
+        node = workflow[node_id]
+        title = node.get("_meta", {}).get("title", "").lower()
+        if "negative" in title:
+            continue  # Skip negative prompt node
+        inputs = node.get("inputs", {})
+        if "text" in inputs:
+            logging.info(f"Patching CLIPTextEncode node {node_id} (title: {title}) with new prompt.")
+            inputs["text"] = prompt_text
+            return
     raise ValueError("No suitable CLIPTextEncode node (non-negative) with 'text' input found in workflow.")
 
 
-def patch_load_image_node(workflow: dict, image_info: dict) -> None:
-    for node_id, node in workflow.items():
-        if node.get("class_type") == "LoadImage":
-            if "image" in node.get("inputs", {}):
-                logging.info(f"Patching LoadImage node {node_id} with uploaded image filename.")
-                node["inputs"]["image"] = image_info["name"]
-                return
+def patch_load_image_node(workflow: dict, image_info: dict, index: Dict[str, List[str]] = None) -> None:
+    if index is None:
+        index = index_workflow(workflow)
+    for node_id in index.get("LoadImage", []):
+        node = workflow[node_id]
+        if "image" in node.get("inputs", {}):
+            logging.info(f"Patching LoadImage node {node_id} with uploaded image filename.")
+            node["inputs"]["image"] = image_info["name"]
+            return
     raise ValueError("No LoadImage node with 'image' input found in workflow.")
 
 
+def workflow_key(workflow: dict) -> str:
+    """
+    Hashes the workflow's node graph (ids and class types only), so runs that only
+    differ in inputs such as prompt text or seed share completion-time statistics.
+    """
+    nodes = sorted(
+        (str(node_id), str(node.get("class_type")))
+        for node_id, node in workflow.items() if isinstance(node, dict)
+    )
+    return hashlib.sha1(repr(nodes).encode("utf-8")).hexdigest()
+
+
+POLL_STATS_PATH = os.path.join(os.path.expanduser("~"), ".cache", "comfy-api", "poll_stats.json")
+POLL_STATS_MAX_SAMPLES = 50
+
+
+def load_poll_stats() -> Dict[str, List[float]]:
+    try:
+        with open(POLL_STATS_PATH, "rb") as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def record_completion_time(key: str, duration: float) -> None:
+    """
+    Appends a completion time for a workflow, keeping only the most recent samples.
+    """
+    stats = load_poll_stats()
+    stats[key] = (stats.get(key, []) + [duration])[-POLL_STATS_MAX_SAMPLES:]
+    try:
+        ensure_folder(os.path.dirname(POLL_STATS_PATH))
+        with open(POLL_STATS_PATH, "wb") as f:
+            f.write(json_dumps(stats))
+    except OSError as e:
+        logging.warning(f"Failed to save poll stats: {e}")
+
+
+def lognormal_poll_schedule(samples: List[float], k: int = 10, quantile: float = 0.99) -> List[float]:
+    """
+    Places k polls (seconds after queueing) to minimise the expected delay between
+    completion and detection, assuming lognormal completion times fitted to samples.
+
+    Optimal polls satisfy L[i+1] = L[i] + (F(L[i]) - F(L[i-1])) / p(L[i]) with L[0] = 0;
+    L[1] is found by bisection so that the last poll lands on U = F^-1(quantile).
+    """
+    logs = [math.log(max(x, 1e-3)) for x in samples]
+    dist = NormalDist(fmean(logs), max(pstdev(logs), 0.05))
+    upper = math.exp(dist.inv_cdf(quantile))
+
+    def cdf(t: float) -> float:
+        return dist.cdf(math.log(t)) if t > 0 else 0.0
+
+    def pdf(t: float) -> float:
+        return dist.pdf(math.log(t)) / t if t > 0 else 0.0
+
+    def place(first: float):
+        # Returns the schedule, or None if it overshoots U before the k-th poll
+        points = [0.0, first]
+        while len(points) <= k:
+            density = pdf(points[-1])
+            if density <= 0:
+                return None
+            nxt = points[-1] + (cdf(points[-1]) - cdf(points[-2])) / density
+            if nxt > upper and len(points) < k:
+                return None
+            points.append(nxt)
+        return points[1:k + 1]
+
+    lo, hi = 0.0, upper
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        points = place(mid)
+        if points is None or points[-1] > upper:
+            hi = mid
+        else:
+            lo = mid
+
+    points = place(lo) or [upper * (i + 1) / k for i in range(k)]
+    points[-1] = upper
+    return points
+
+
 def ensure_folder(path: str):
     os.makedirs(path, exist_ok=True)
 
 
-def upload_to_s3(image_bytes: bytes, bucket_name: str, object_key: str, region: str,
-                 access_key: str, secret_key: str, endpoint_url: str = None):
-    try:
-        session = boto3.session.Session(
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key,
-            region_name=region
-        )
-        s3 = session.client("s3", endpoint_url=endpoint_url)
+@lru_cache(maxsize=None)
+def get_s3_client(region: str, access_key: str, secret_key: str, endpoint_url: str = None):
+    """
+    Returns a shared S3 client per configuration so uploads reuse its connection pool.
+    """
+    session = boto3.session.Session(
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        region_name=region
+    )
+    return session.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=16, retries={"max_attempts": 3, "mode": "adaptive"})
+    )
+
+
+# Bodies above 8 MB are split into parts uploaded in parallel
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True
+)
+
+
+def upload_to_s3(s3_client, bucket_name: str, object_key: str, fileobj: BinaryIO, compress: bool = False):
+    """
+    Uploads an image stream. With compress=True the body is gzipped (fastest level,
+    so compression outpaces the upload link) and stored as '<object_key>.gz'.
+    """
+    extra_args = {"ContentType": "image/png"}
+    if compress:
+        fileobj = gzip_to_spool(fileobj)
+        object_key = f"{object_key}.gz"
+        extra_args["ContentEncoding"] = "gzip"
 
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=object_key,
-            Body=image_bytes,
-            ContentType="image/png"
+    try:
+        s3_client.upload_fileobj(
+            fileobj,
+            bucket_name,
+            object_key,
+            Config=S3_TRANSFER_CONFIG,
+            ExtraArgs=extra_args
         )
         logging.info(f"Uploaded to S3: s3://{bucket_name}/{object_key}")
     except (BotoCoreError, NoCredentialsError) as e:
         logging.error(f"Failed to upload to S3: {e}")
+    finally:
+        if compress:
+            fileobj.close()
+
 
+# Compressed bodies larger than this spill from memory to a temporary file
+GZIP_SPOOL_MAX_SIZE = 8 * 1024 * 1024
 
-def get_image_file(server_address: str, filename: str, subfolder: str, folder_type: str) -> bytes:
-    query = urllib.parse.urlencode({
-        "filename": filename,
-        "subfolder": subfolder,
-        "type": folder_type
-    })
-    url = f"http://{server_address}/view?{query}"
-    with urllib.request.urlopen(url) as response:
-        return response.read()
 
+def gzip_to_spool(fileobj: BinaryIO) -> BinaryIO:
+    """
+    Gzips a stream chunk by chunk into a spooled temporary file, rewound for reading.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=GZIP_SPOOL_MAX_SIZE)
+    with gzip.GzipFile(fileobj=spool, mode="wb", compresslevel=1) as gz:
+        shutil.copyfileobj(fileobj, gz)
+    spool.seek(0)
+    return spool
 
-def prepare_image_for_upload(image_path: str) -> Tuple[str, str, str]:
+
+def prepare_image_for_upload(image_path: str, http: requests.Session = None) -> Tuple[BinaryIO, str, str]:
     """
     Handles image input from either URL or local path.
-    Returns (upload_path, filename, mime_type).
-    If it's a URL, downloads to a temporary file.
+    Returns (stream, filename, mime_type); the caller must close the stream.
+    If it's a URL, the download is streamed rather than staged to disk.
     """
     is_url = urlparse(image_path).scheme in ("http", "https")
 
     if is_url:
-        response = urllib.request.urlopen(image_path)
-        suffix = os.path.splitext(image_path)[-1] or ".jpg"
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        temp_file.write(response.read())
-        temp_file.close()
-        return temp_file.name, os.path.basename(urlparse(image_path).path), "image/png"
+        filename = os.path.basename(urlparse(image_path).path)
+        response = (http or requests).get(image_path, stream=True)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        response.raw.decode_content = True
+        content_type = response.headers.get("Content-Type", "").split(";")[0]
+        mime_type = mimetypes.guess_type(filename)[0] or content_type or "application/octet-stream"
+        return response.raw, filename, mime_type
     else:
-        return image_path, os.path.basename(image_path), "image/png"
+        filename = os.path.basename(image_path)
+        mime_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        return open(image_path, "rb"), filename, mime_type
 
 
-def upload_input_image(image_path: str, server_address: str) -> dict:
+def iter_multipart(boundary: str, fields: Dict[str, str], file_field: str, filename: str,
+                   fileobj: BinaryIO, mime_type: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
     """
-    Uploads an image (from local path or URL) to the ComfyUI /upload/image endpoint.
+    Yields a multipart/form-data body chunk by chunk, so the file is never held in memory whole.
     """
-    from requests import post
+    for name, value in fields.items():
+        yield f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+    filename = filename.replace('"', "%22")
+    yield (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f"Content-Type: {mime_type}\r\n\r\n"
+    ).encode("utf-8")
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
 
-    upload_path, filename, mime_type = prepare_image_for_upload(image_path)
+def upload_input_image(image_path: str, server_address: str, http: requests.Session = None) -> dict:
+    """
+    Uploads an image (from local path or URL) to the ComfyUI /upload/image endpoint.
+    The multipart body is streamed with chunked transfer encoding.
+    """
+    source, filename, mime_type = prepare_image_for_upload(image_path, http)
     url = f"http://{server_address.rstrip('/')}/upload/image"
+    boundary = uuid.uuid4().hex
 
-    try:
-        with open(upload_path, 'rb') as img_file:
-            files = {'image': (filename, img_file, mime_type)}
-            data = {'overwrite': 'true', 'type': 'input'}
-            response = post(url, files=files, data=data)
-            response.raise_for_status()
-            result = response.json()
-            logging.info(f"Uploaded image to ComfyUI: {result}")
-            return result
-    finally:
-        # Clean up temp file if applicable
-        if upload_path != image_path and os.path.exists(upload_path):
-            os.unlink(upload_path)
+    with source:
+        fields = {'overwrite': 'true', 'type': 'input'}
+        body = iter_multipart(boundary, fields, 'image', filename, source, mime_type)
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        response = (http or requests).post(url, data=body, headers=headers)
+        response.raise_for_status()
+        result = response.json()
+        logging.info(f"Uploaded image to ComfyUI: {result}")
+        return result